@@ -19,5 +19,5 @@ import setuptools
 setuptools.setup(
     name='skai',
     version='0.0.1',
-    install_requires=[],
+    install_requires=['numba'],
     packages=setuptools.find_packages())
@@ -21,7 +21,6 @@ import apache_beam as beam
 import numpy as np
 import pyproj
 import rasterio
-import rasterio.plot
 from skai import utils
 import tensorflow as tf
 from skai import extract_tiles_constants
@@ -216,9 +215,15 @@ class ExtractTilesAsExamplesFn(beam.DoFn):
       raise ValueError(f'Tile extents out of bounds: x={tile.x}, y={tile.y}')
 
     window = rasterio.windows.Window(tile.x, tile.y, tile.width, tile.height)
-    window_data = self._input_file.read(
-        window=window, boundless=True, fill_value=0)
-    window_data = rasterio.plot.reshape_as_image(window_data)
+    # Read directly into a (row, col, channel) buffer. Rasterio respects the
+    # strides of the output array, so passing a transposed view lets GDAL
+    # interleave the bands instead of transposing in a separate pass.
+    window_data = np.empty(
+        (tile.height, tile.width, self._input_file.count),
+        dtype=self._input_file.dtypes[0])
+    self._input_file.read(
+        window=window, boundless=True, fill_value=0,
+        out=np.moveaxis(window_data, 2, 0))
     # Dimensions should be (row, col, channel).
     height, width, _ = window_data.shape
 
@@ -13,30 +13,31 @@
 # limitations under the License.
 """Pipeline for generating tensorflow examples from satellite images."""
 
+import concurrent.futures
 import dataclasses
+import functools
 import logging
 import os
 import pathlib
 import random
 import time
-from typing import Dict, Iterator, List, Optional, Tuple
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 import apache_beam as beam
 import cv2
 import geopandas as gpd
+import numba
 import numpy as np
 import PIL
 import PIL.Image
 import pyproj
 import rasterio
-import rasterio.plot
-from skai import beam_utils
+import shapely
 from skai import cloud_labeling
 from skai import utils
 import tensorflow as tf
 
 
 Example = tf.train.Example
-Image = PIL.Image.Image
 Metrics = beam.metrics.Metrics
 PipelineOptions = beam.options.pipeline_options.PipelineOptions
 
@@ -48,51 +49,96 @@ _BLANK_THRESHOLD = 0.25
 # documentation on template matching for the list of options.
 _ALIGNMENT_METHOD = cv2.TM_CCOEFF_NORMED
 
+# Resampling method used when reading image patches at a resolution different
+# from the source image's. The alignment patches are also cropped into the
+# examples, so they need the higher quality kernel rather than e.g. bilinear.
+_RESAMPLING = rasterio.enums.Resampling.lanczos
+
 # Maximum number of pixels that an image can be displaced during alignment.
 _MAX_DISPLACEMENT = 30
 
-# Multi-output tags for GenerateExamplesFn.
-_EXAMPLES = 'examples'
-_LABELING_IMAGES = 'label_images'
+# Maximum size in output pixels of each side of a window read to fetch the
+# patches for several nearby coordinates at once. Coordinates that are farther
+# apart are fetched with separate reads.
+_MAX_READ_SIZE = 1024
+
+# PNG compression level for encoded image patches. Patches are small and
+# encoding is on the critical path, so favor speed over file size.
+_PNG_COMPRESS_LEVEL = 1
 
 # Maximum number of dataflow workers to use.
 _MAX_DATAFLOW_WORKERS = 20
 
+# Alignment in bytes of scratch buffers used for raster reads.
+_CACHE_LINE_BYTES = 64
+
 # Maximum QPS for the Earth Engine API. Should be respected when using the EEDAI
 # interface (https://gdal.org/drivers/raster/eedai.html).
 _EARTH_ENGINE_QPS = 100
 
 
-@dataclasses.dataclass
-class _Coordinate:
-  """Class that encodes a geographic position and a label.
+# Coordinates flow through the pipeline as (longitude, latitude, label) tuples,
+# which are much cheaper to create and encode than objects.
+_Coordinate = Tuple[float, float, float]
 
-  Attributes:
-    longitude: Longitude.
-    latitude: Latitude.
-    label: Label for for this coordinate.
+
+def _check_coordinates(coordinates: np.ndarray) -> None:
+  """Checks that coordinates have valid longitudes and latitudes.
+
+  Args:
+    coordinates: Array of coordinates. The first column holds longitudes and the
+      second column holds latitudes.
+
+  Raises:
+    ValueError: If any longitude or latitude is out of range.
   """
-  longitude: float
-  latitude: float
-  label: float
+  longitudes = coordinates[:, 0]
+  latitudes = coordinates[:, 1]
+  # Written so that NaNs are also rejected.
+  invalid = ~((longitudes >= -180) & (longitudes <= 180))
+  if invalid.any():
+    raise ValueError(f'Invalid longitude, got {longitudes[invalid][0]}')
+  invalid = ~((latitudes >= -90) & (latitudes <= 90))
+  if invalid.any():
+    raise ValueError(f'Invalid latitude, got {latitudes[invalid][0]}')
+
+
+def _to_coordinate_array(
+    coordinates: List[Tuple[float, ...]], label: Optional[float] = None
+) -> np.ndarray:
+  """Validates coordinates and packs them into a single array.
+
+  Args:
+    coordinates: List of (longitude, latitude) or (longitude, latitude, label)
+      tuples.
+    label: If specified, the label given to all coordinates. Otherwise labels
+      are taken from the third element of each input tuple.
+
+  Returns:
+    Array with shape (N, 3) holding longitude, latitude and label columns.
+  """
+  array = np.asarray(coordinates, dtype=np.float64).reshape(
+      len(coordinates), -1)
+  _check_coordinates(array)
+  if label is not None:
+    array = np.column_stack([array[:, :2], np.full(len(array), label)])
+  return array
 
-  def __post_init__(self):
-    # Check if the longitude and latitude are valid
-    if not -180 <= self.longitude <= 180:
-      raise ValueError(
-          f'Invalid longitude, got {self.longitude}'
-      )
-    if not -90 <= self.latitude <= 90:
-      raise ValueError(
-          f'Invalid latitude, got {self.latitude}'
-      )
 
+def _to_coordinate_tuples(coordinates: np.ndarray) -> List[_Coordinate]:
+  return list(map(tuple, coordinates.tolist()))
 
-def _to_grayscale(image: np.ndarray) -> np.ndarray:
-  return cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
 
+def _to_grayscale(
+    image: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+  return cv2.cvtColor(image, cv2.COLOR_RGB2GRAY, dst=out)
 
-def align_after_image(before_image: np.ndarray, after_image: np.ndarray):
+
+def align_after_image(
+    before_image: np.ndarray,
+    after_image: np.ndarray,
+    before_gray: Optional[np.ndarray] = None,
+    after_gray: Optional[np.ndarray] = None) -> np.ndarray:
   """Aligns after image to before image.
 
   Uses OpenCV template matching algorithm to align before and after
@@ -103,40 +149,96 @@ def align_after_image(before_image: np.ndarray, after_image: np.ndarray):
   Args:
     before_image: Before image.
     after_image: After image.
+    before_gray: Optional preallocated buffer for the grayscale before image.
+    after_gray: Optional preallocated buffer for the grayscale after image.
 
   Returns:
     A crop of after_image that is the same size as before_image and is best
     aligned to it.
   """
+  rows = before_image.shape[0]
+  cols = before_image.shape[1]
+
   result = cv2.matchTemplate(
-      _to_grayscale(after_image), _to_grayscale(before_image),
+      _to_grayscale(after_image, after_gray),
+      _to_grayscale(before_image, before_gray),
       _ALIGNMENT_METHOD)
   _, _, _, max_location = cv2.minMaxLoc(result)
   j, i = max_location
-  rows = before_image.shape[0]
-  cols = before_image.shape[1]
   aligned_after = after_image[i:i + rows, j:j + cols, :]
   return aligned_after
 
 
-def _get_blank_fraction(data: np.ndarray) -> float:
-  """Get the fraction of blank elements in an array.
+@numba.njit(cache=True, fastmath=True)
+def _process_patch(data: np.ndarray) -> Tuple[float, np.ndarray, int]:
+  """Computes the blank fraction of a patch and converts it to a uint8 image.
 
-  Assumes that the first dimension of the input data is the channel dimension. A
-  pixel is considered blank if it has 0s in all channels.
+  This does in a single pass over the patch what would otherwise take several
+  numpy passes: counting blank pixels, clipping negative values to 0, finding
+  the maximum value for range checking, and transposing from rasterio's
+  [channels, rows, cols] order to [rows, cols, channels]. A pixel is considered
+  blank if it has 0s in all channels.
 
   Args:
-    data: Input array.
+    data: Integer patch array with dimensions [3, rows, cols].
 
   Returns:
-    Fraction of data that is all 0s.
+    Tuple of the fraction of blank pixels, the uint8 image with dimensions
+    [rows, cols, 3], and the maximum pixel value after clipping. If the maximum
+    is greater than 255, the uint8 image is not valid.
+  """
+  _, rows, cols = data.shape
+  image = np.empty((rows, cols, 3), dtype=np.uint8)
+  num_blank = 0
+  max_value = 0
+  for i in range(rows):
+    for j in range(cols):
+      r = data[0, i, j]
+      g = data[1, i, j]
+      b = data[2, i, j]
+      if (r | g | b) == 0:
+        num_blank += 1
+      r = max(r, 0)
+      g = max(g, 0)
+      b = max(b, 0)
+      max_value = max(max_value, r, g, b)
+      image[i, j, 0] = r
+      image[i, j, 1] = g
+      image[i, j, 2] = b
+  if rows * cols == 0:
+    return 0.0, image, max_value
+  return num_blank / (rows * cols), image, max_value
+
+
+class _ReadBuffer:
+  """Scratch buffer that raster reads can be written into.
+
+  The buffer is reused across reads and only reallocated when a read needs more
+  space than any previous one, which avoids allocating a new array per read.
+  The start of the buffer is aligned to a cache line.
   """
-  if data.size == 0:
-    return 0
 
-  flattened = data.max(axis=0)
-  num_non_blank = np.count_nonzero(flattened)
-  return (flattened.size - num_non_blank) / flattened.size
+  def __init__(self) -> None:
+    self._buffer = np.empty(0, dtype=np.uint8)
+
+  def get(self, shape: Tuple[int, ...], dtype: np.dtype) -> np.ndarray:
+    """Returns a view of the buffer with the requested shape and dtype.
+
+    The contents of the view are overwritten by later calls.
+
+    Args:
+      shape: Array shape.
+      dtype: Array dtype.
+
+    Returns:
+      Uninitialized array backed by the buffer.
+    """
+    num_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    if self._buffer.size < num_bytes:
+      raw = np.empty(num_bytes + _CACHE_LINE_BYTES, dtype=np.uint8)
+      offset = -raw.ctypes.data % _CACHE_LINE_BYTES
+      self._buffer = raw[offset:offset + num_bytes]
+    return self._buffer[:num_bytes].view(dtype).reshape(shape)
 
 
 def _get_raster_resolution_in_meters(raster) -> float:
@@ -167,92 +269,384 @@ def _get_raster_resolution_in_meters(raster) -> float:
   return raster.res[0] * meter_conversion_factor
 
 
-def _convert_to_uint8(image: np.ndarray) -> np.ndarray:
-  """Converts an image to uint8.
+def _get_transformer(raster) -> pyproj.Transformer:
+  """Returns a transformer from longitude, latitude into the raster's CRS."""
+  # Set always_xy=True so that transformer always expects longitude, latitude in
+  # that order.
+  return pyproj.Transformer.from_crs('epsg:4326', raster.crs, always_xy=True)
+
 
-  This function currently only handles converting from various integer types to
-  uint8, with range checks to make sure the casting is safe. If needed, this
-  function can be adapted to handle float types.
+def _transform_batch(
+    transformer: pyproj.Transformer,
+    longitudes: List[float],
+    latitudes: List[float]) -> Tuple[np.ndarray, np.ndarray]:
+  """Transforms a batch of coordinates with a single call into PROJ.
 
   Args:
-    image: Input image array.
+    transformer: Transformer from longitude, latitude to the target CRS.
+    longitudes: Longitudes to transform.
+    latitudes: Latitudes to transform.
 
   Returns:
-    uint8 array.
-
+    Tuple of x and y coordinate arrays in the target CRS.
   """
-  if not np.issubdtype(image.dtype, np.integer):
-    raise TypeError(f'Image type {image.dtype} not supported.')
-  if np.min(image) < 0 or np.max(image) > 255:
-    raise ValueError(
-        f'Pixel values have a range of {np.min(image)}-{np.max(image)}. '
-        'Only 0-255 is supported.')
-  return image.astype(np.uint8)
+  return transformer.transform(
+      np.asarray(longitudes), np.asarray(latitudes), errcheck=True)
 
 
-def get_patch_at_coordinate(
+def get_patches_at_coordinates(
     raster,
-    longitude: float,
-    latitude: float,
+    longitudes: List[float],
+    latitudes: List[float],
     patch_size: int,
     resolution: float,
-    wait_seconds: float) -> Optional[np.ndarray]:
-  """Extracts image patch from a raster.
+    wait_seconds: float,
+    resampling: rasterio.enums.Resampling = _RESAMPLING
+) -> List[Optional[np.ndarray]]:
+  """Extracts image patches centered at several coordinates from a raster.
+
+  Rather than issuing one read per coordinate, this function reads a single
+  window that encloses the patches for all of the coordinates and slices the
+  individual patches out of it in memory. It is meant to be called with
+  coordinates that are spatially close together, e.g. that fall in the same
+  raster block.
 
   Args:
     raster: Input raster.
-    longitude: Longitude of center of patch to extract.
-    latitude: Latitude of center of patch to extract.
+    longitudes: Longitudes of the centers of the patches to extract.
+    latitudes: Latitudes of the centers of the patches to extract.
     patch_size: Patch size.
-    resolution: Desired resolution of output patch.
+    resolution: Desired resolution of output patches.
     wait_seconds: Seconds to wait after reads to avoid exceeding QPS limits.
+    resampling: Resampling method used when the raster's resolution differs
+      from the desired resolution.
 
   Returns:
-    The image patch, or None if the coordinates are out of the bounds of the
-    raster.
+    List of image patches in the same order as the input coordinates. An entry
+    is None if the patch is mostly out of the bounds of the raster.
   """
-  # Set always_xy=True so that transformer always expects longitude, latitude in
-  # that order.
-  transformer = pyproj.Transformer.from_crs(
-      'epsg:4326', raster.crs, always_xy=True)
-  x, y = transformer.transform(longitude, latitude, errcheck=True)
-  row, col = raster.index(x, y)
+  xs, ys = _transform_batch(_get_transformer(raster), longitudes, latitudes)
+  geometry = _get_patch_geometry(
+      _get_raster_resolution_in_meters(raster), patch_size, resolution)
+  return _get_patches_at_points(
+      raster, geometry, xs, ys, wait_seconds, resampling)
+
+
+@dataclasses.dataclass(frozen=True)
+class _PatchGeometry:
+  """Sizes for reading patches of a fixed size from a raster.
 
-  raster_res = _get_raster_resolution_in_meters(raster)
+  These only depend on the raster's resolution and the pipeline's patch size
+  and output resolution, so they can be computed once per raster.
+
+  Attributes:
+    patch_size: Size of output patches.
+    input_size: Size of a patch in raster pixels. Each patch is resampled from
+      input_size raster pixels to patch_size output pixels.
+    half_size: Half the size of a patch in raster pixels.
+  """
+  patch_size: int
+  input_size: int
+  half_size: int
+
+
+def _get_patch_geometry(
+    raster_res: float, patch_size: int, resolution: float) -> _PatchGeometry:
+  """Computes the sizes for reading patches from a raster.
+
+  Args:
+    raster_res: Resolution of the raster in meters.
+    patch_size: Patch size.
+    resolution: Desired resolution of output patches.
+
+  Returns:
+    Patch geometry.
+  """
   scale_factor = resolution / raster_res
   input_size = int(patch_size * scale_factor)
+  return _PatchGeometry(patch_size, input_size, input_size // 2)
+
+
+def _get_patch_offsets(
+    raster,
+    geometry: _PatchGeometry,
+    xs: np.ndarray,
+    ys: np.ndarray) -> np.ndarray:
+  """Computes the raster pixel offsets of patches centered at several points.
+
+  Args:
+    raster: Input raster.
+    geometry: Patch geometry for the raster.
+    xs: X coordinates of the centers of the patches in the raster's CRS.
+    ys: Y coordinates of the centers of the patches in the raster's CRS.
+
+  Returns:
+    Integer array with shape (N, 2) holding the row and column of the top left
+    corner of each patch in the raster.
+  """
+  rows, cols = rasterio.transform.rowcol(raster.transform, xs, ys)
+  rows = np.atleast_1d(np.asarray(rows, dtype=np.int64))
+  cols = np.atleast_1d(np.asarray(cols, dtype=np.int64))
+  return np.stack([rows, cols], axis=1) - geometry.half_size
+
+
+def _get_read_cells(
+    geometry: _PatchGeometry, offsets: np.ndarray) -> np.ndarray:
+  """Assigns patches to cells of a grid sized to bound the read window.
+
+  All patches in a cell can be fetched with a single read whose output is at
+  most _MAX_READ_SIZE pixels on each side.
+
+  Args:
+    geometry: Patch geometry for the raster.
+    offsets: Patch offsets returned by _get_patch_offsets.
+
+  Returns:
+    Integer array with shape (N, 2) holding the grid cell of each patch.
+  """
+  cell_size = max(
+      1, (_MAX_READ_SIZE - geometry.patch_size) * geometry.input_size //
+      geometry.patch_size)
+  return (offsets - offsets.min(axis=0)) // cell_size
+
+
+def _split_by_cells(cells: np.ndarray) -> List[np.ndarray]:
+  """Splits patch indices into groups that share a grid cell.
+
+  Args:
+    cells: Integer array with shape (N, K) of grid cells. Patches are grouped
+      together if all K cell indices match, so that cells from several rasters
+      can be combined by stacking them horizontally.
+
+  Returns:
+    List of arrays of patch indices, one per group.
+  """
+  _, group_ids = np.unique(cells, axis=0, return_inverse=True)
+  group_ids = group_ids.ravel()
+  return [np.flatnonzero(group_ids == g) for g in range(group_ids.max() + 1)]
 
-  half_size = input_size // 2
-  col_off = col - half_size
-  row_off = row - half_size
-  window = rasterio.windows.Window(col_off, row_off, input_size, input_size)
+
+@dataclasses.dataclass(frozen=True)
+class _PatchRead:
+  """Describes a raster read that covers a batch of patches.
+
+  Attributes:
+    window: Raster window enclosing all patches.
+    out_shape: Shape of the resampled window data, as [channels, rows, cols].
+    row_offsets: Row offset of each patch in the resampled window data.
+    col_offsets: Column offset of each patch in the resampled window data.
+    patch_size: Patch size.
+    dtype: Data type of the window data. This is the raster's native type, so
+      8-bit rasters are read straight into uint8 buffers without widening.
+  """
+  window: rasterio.windows.Window
+  out_shape: Tuple[int, int, int]
+  row_offsets: np.ndarray
+  col_offsets: np.ndarray
+  patch_size: int
+  dtype: np.dtype
+
+
+def _plan_patch_read(
+    raster,
+    geometry: _PatchGeometry,
+    offsets: np.ndarray) -> _PatchRead:
+  """Computes the single read that covers several patches.
+
+  Args:
+    raster: Input raster.
+    geometry: Patch geometry for the raster.
+    offsets: Patch offsets returned by _get_patch_offsets. These should be
+      from a single group returned by _split_by_cells, so that the read stays
+      bounded.
+
+  Returns:
+    Description of the read.
+
+  Raises:
+    TypeError: If the raster doesn't have an integer data type.
+  """
+  # Patches are only converted from various integer types to uint8, with range
+  # checks to make sure the casting is safe. Check this before paying for I/O.
+  dtype = np.dtype(raster.dtypes[0])
+  if not np.issubdtype(dtype, np.integer):
+    raise TypeError(f'Image type {dtype} not supported.')
+
+  # Compute the window enclosing all patches. Raster pixels are mapped to
+  # output pixels with the same ratio of input_size to patch_size that a read
+  # of a single patch uses, so a window holding one patch covers exactly
+  # input_size raster pixels. Patch offsets are converted into the output
+  # resolution so that the patches can be sliced out of the resampled window.
+  # When the offset between two patches isn't a whole number of output pixels,
+  # it is rounded, which moves the patch by at most half an output pixel.
+  patch_size = geometry.patch_size
+  input_size = geometry.input_size
+  min_row, min_col = offsets.min(axis=0)
+  out_offsets = np.round(
+      (offsets - [min_row, min_col]) * patch_size / input_size).astype(int)
+  out_height, out_width = out_offsets.max(axis=0) + patch_size
+  window = rasterio.windows.Window(
+      int(min_col), int(min_row), out_width * input_size / patch_size,
+      out_height * input_size / patch_size)
+  return _PatchRead(window, (3, int(out_height), int(out_width)),
+                    out_offsets[:, 0], out_offsets[:, 1], patch_size, dtype)
+
+
+def _read_window(
+    raster,
+    patch_read: _PatchRead,
+    wait_seconds: float,
+    resampling: rasterio.enums.Resampling,
+    read_buffer: Optional[_ReadBuffer]) -> Tuple[np.ndarray, float]:
+  """Reads the raster window for a batch of patches.
+
+  This function only does I/O and doesn't record Beam metrics, so it can be run
+  on a background thread as long as no other thread is reading from the same
+  raster or read buffer at the same time. The calling thread must have entered
+  a rasterio environment with the pipeline's GDAL configuration.
+
+  Args:
+    raster: Input raster.
+    patch_read: Description of the read.
+    wait_seconds: Seconds to wait after reads to avoid exceeding QPS limits.
+    resampling: Resampling method used when the raster's resolution differs
+      from the desired resolution.
+    read_buffer: Optional scratch buffer to read raster data into. If None, a
+      new array is allocated for the read.
+
+  Returns:
+    Tuple of the window data and the read time in milliseconds.
+  """
+  if read_buffer is None:
+    out = np.empty(patch_read.out_shape, dtype=patch_read.dtype)
+  else:
+    out = read_buffer.get(patch_read.out_shape, patch_read.dtype)
   start_time = time.time()
+  # Currently assumes that bands [1, 2, 3] of the input image are the RGB
+  # channels.
+  window_data = raster.read(
+      indexes=[1, 2, 3], window=patch_read.window, boundless=True,
+      fill_value=-1, out=out, resampling=resampling)
+  elapsed_millis = (time.time() - start_time) * 1000
+  time.sleep(wait_seconds)
+  return window_data, elapsed_millis
+
+
+def _extract_patches(
+    read_window: Callable[[], Tuple[np.ndarray, float]],
+    patch_read: _PatchRead) -> List[Optional[np.ndarray]]:
+  """Slices patches out of a raster window and converts them to uint8.
+
+  Args:
+    read_window: Function that returns the result of _read_window, e.g. the
+      result method of a future.
+    patch_read: Description of the read.
+
+  Returns:
+    List of image patches in the same order as the offsets in patch_read. An
+    entry is None if the patch is mostly blank.
+  """
   try:
-    # Currently assumes that bands [1, 2, 3] of the input image are the RGB
-    # channels.
-    window_data = raster.read(
-        indexes=[1, 2, 3], window=window, boundless=True, fill_value=-1,
-        out_shape=(3, patch_size, patch_size),
-        resampling=rasterio.enums.Resampling.lanczos)
+    window_data, elapsed_millis = read_window()
   except rasterio.errors.RasterioError:
-    logging.exception('Rasterio read error in _get_patch_at_coordinate')
+    logging.exception('Rasterio read error in get_patches_at_coordinates')
     Metrics.counter('skai', 'rasterio_error').inc()
-    return None
-  finally:
-    elapsed_millis = (time.time() - start_time) * 1000
-    Metrics.distribution('skai', 'raster_read_time_msec').update(elapsed_millis)
+    return [None] * len(patch_read.row_offsets)
+  Metrics.distribution('skai', 'raster_read_time_msec').update(elapsed_millis)
+
+  patch_size = patch_read.patch_size
+  patches = []
+  for i, j in zip(patch_read.row_offsets, patch_read.col_offsets):
+    patch_data = window_data[:, i:i + patch_size, j:j + patch_size]
+    blank_fraction, patch, max_value = _process_patch(patch_data)
+    if blank_fraction > _BLANK_THRESHOLD:
+      Metrics.counter('skai', 'blank_patches').inc()
+      patches.append(None)
+      continue
+    if max_value > 255:
+      raise ValueError(
+          f'Pixel values have a maximum of {max_value}. '
+          'Only 0-255 is supported.')
+    patches.append(patch)
+  return patches
 
-  time.sleep(wait_seconds)
 
-  if _get_blank_fraction(window_data) > _BLANK_THRESHOLD:
-    Metrics.counter('skai', 'blank_patches').inc()
-    return None
-  window_data = np.clip(window_data, 0, None)
-  window_data = rasterio.plot.reshape_as_image(window_data)
-  return _convert_to_uint8(window_data)
+def _get_patches_at_points(
+    raster,
+    geometry: _PatchGeometry,
+    xs: np.ndarray,
+    ys: np.ndarray,
+    wait_seconds: float,
+    resampling: rasterio.enums.Resampling = _RESAMPLING,
+    read_buffer: Optional[_ReadBuffer] = None
+) -> List[Optional[np.ndarray]]:
+  """Extracts image patches centered at points in the raster's CRS.
+
+  See get_patches_at_coordinates.
+
+  Args:
+    raster: Input raster.
+    geometry: Patch geometry for the raster.
+    xs: X coordinates of the centers of the patches in the raster's CRS.
+    ys: Y coordinates of the centers of the patches in the raster's CRS.
+    wait_seconds: Seconds to wait after reads to avoid exceeding QPS limits.
+    resampling: Resampling method used when the raster's resolution differs
+      from the desired resolution.
+    read_buffer: Optional scratch buffer to read raster data into. If None, a
+      new array is allocated for the read.
+
+  Returns:
+    List of image patches in the same order as the input points.
+  """
+  xs = np.atleast_1d(xs)
+  if not xs.size:
+    return []
+
+  offsets = _get_patch_offsets(raster, geometry, xs, ys)
+  patches = [None] * len(offsets)
+  for indices in _split_by_cells(_get_read_cells(geometry, offsets)):
+    patch_read = _plan_patch_read(raster, geometry, offsets[indices])
+    group_patches = _extract_patches(
+        functools.partial(
+            _read_window, raster, patch_read, wait_seconds, resampling,
+            read_buffer),
+        patch_read)
+    for i, patch in zip(indices, group_patches):
+      patches[i] = patch
+  return patches
+
+
+def get_patch_at_coordinate(
+    raster,
+    longitude: float,
+    latitude: float,
+    patch_size: int,
+    resolution: float,
+    wait_seconds: float,
+    resampling: rasterio.enums.Resampling = _RESAMPLING
+) -> Optional[np.ndarray]:
+  """Extracts image patch from a raster.
+
+  Args:
+    raster: Input raster.
+    longitude: Longitude of center of patch to extract.
+    latitude: Latitude of center of patch to extract.
+    patch_size: Patch size.
+    resolution: Desired resolution of output patch.
+    wait_seconds: Seconds to wait after reads to avoid exceeding QPS limits.
+    resampling: Resampling method used when the raster's resolution differs
+      from the desired resolution.
+
+  Returns:
+    The image patch, or None if the coordinates are out of the bounds of the
+    raster.
+  """
+  return get_patches_at_coordinates(
+      raster, [longitude], [latitude], patch_size, resolution, wait_seconds,
+      resampling)[0]
 
 
-def _create_example(before_image: Image, after_image: Image,
+def _create_example(before_image: np.ndarray, after_image: np.ndarray,
                     longitude: float, latitude: float, label: float) -> Example:
   """Create Tensorflow Example from inputs.
 
@@ -268,10 +662,12 @@ def _create_example(before_image: Image, after_image: Image,
   """
   example = tf.train.Example()
   # TODO(jzxu): Use constants for these feature name strings.
-  utils.add_bytes_feature('pre_image_png',
-                          utils.serialize_image(before_image, 'png'), example)
-  utils.add_bytes_feature('post_image_png',
-                          utils.serialize_image(after_image, 'png'), example)
+  utils.add_bytes_feature(
+      'pre_image_png',
+      utils.serialize_image(before_image, 'png', _PNG_COMPRESS_LEVEL), example)
+  utils.add_bytes_feature(
+      'post_image_png',
+      utils.serialize_image(after_image, 'png', _PNG_COMPRESS_LEVEL), example)
   utils.add_float_feature('coordinates', longitude, example)
   utils.add_float_feature('coordinates', latitude, example)
   utils.add_bytes_feature('encoded_coordinates',
@@ -282,7 +678,7 @@ def _create_example(before_image: Image, after_image: Image,
   return example
 
 
-def _center_crop(image: np.ndarray, crop_size: int) -> Image:
+def _center_crop(image: np.ndarray, crop_size: int) -> np.ndarray:
   """Crops an image into a square of a specified size.
 
   Args:
@@ -290,22 +686,60 @@ def _center_crop(image: np.ndarray, crop_size: int) -> Image:
     crop_size: Length and width of the cropped image.
 
   Returns:
-    The cropped image.
+    The cropped image as a view into the input array.
   """
   rows = image.shape[0]
   cols = image.shape[1]
   i = rows // 2 - crop_size // 2
   j = cols // 2 - crop_size // 2
-  crop = image[i:i + crop_size, j:j + crop_size, :]
-  return PIL.Image.fromarray(crop)
+  return image[i:i + crop_size, j:j + crop_size, :]
+
+
+def _enter_gdal_env(gdal_env: Dict[str, str]) -> None:
+  """Enters a rasterio environment for the rest of the calling thread's life.
+
+  Used to initialize reader threads, which don't see the environment entered
+  by the thread that created them.
+
+  Args:
+    gdal_env: GDAL environment configuration.
+  """
+  rasterio.Env(**gdal_env).__enter__()
+
+
+def _get_after_patch_size(
+    has_before_image: bool,
+    example_patch_size: int,
+    alignment_patch_size: int,
+    labeling_patch_size: int) -> int:
+  """Returns the size of the after image patches read for each coordinate.
+
+  Args:
+    has_before_image: Whether there is a before image.
+    example_patch_size: Size of patches in examples.
+    alignment_patch_size: Size of patches used for alignment.
+    labeling_patch_size: Size of patches in labeling images.
+
+  Returns:
+    After image patch size.
+  """
+  if not has_before_image:
+    # The after patch is read at the size of the largest output.
+    return max(example_patch_size, labeling_patch_size)
+  # Make the after image patch larger than the before image patch by giving it
+  # a border of _MAX_DISPLACEMENT pixels. This gives the alignment algorithm at
+  # most +/-_MAX_DISPLACEMENT pixels of movement in either dimension to find the
+  # best alignment.
+  return alignment_patch_size + 2 * _MAX_DISPLACEMENT
 
 
 class GenerateExamplesFn(beam.DoFn):
   """DoFn that extracts patches from before and after images into examples.
 
-  The DoFn takes as input a list of (longitude, latitude) coordinates and
-  extracts patches centered at each coordinate from the before and after images,
-  and creates Tensorflow Examples containing these patches.
+  The DoFn takes as input groups of (longitude, latitude) coordinates keyed by
+  the raster block they fall in (see AssignRasterBlockFn), extracts patches
+  centered at each coordinate from the before and after images, and creates
+  Tensorflow Examples containing these patches.
 
   The after image is also aligned to the before image during this process. The
   maximum displacement that can occur in alignment is _MAX_DISPLACEMENT pixels.
@@ -314,6 +748,8 @@ class GenerateExamplesFn(beam.DoFn):
     _before_path: Path to before disaster image.
     _after_path: Path to after disaster image.
     _labeling_image_sample_rate: Rate at which to sample labeling images.
+    _labeling_images_dir: Directory that sampled labeling images are written
+      to.
     _example_patch_size: Size in pixels of the before and after image patches
       included in the examples.
     _alignment_patch_size: Size in pixels of the before and after image patches
@@ -325,12 +761,15 @@ class GenerateExamplesFn(beam.DoFn):
       this is different from the image's native resolution, patches will be
       upsampled or downsampled.
     _gdal_env: GDAL environment configuration.
+    _seconds_between_reads: Seconds to wait after each raster read to stay
+      within the Earth Engine QPS limit, or 0 if no limit applies.
   """
 
   def __init__(self,
                before_path: str,
                after_path: str,
                labeling_image_sample_rate: float,
+               labeling_images_dir: str,
                example_patch_size: int,
                alignment_patch_size: int,
                labeling_patch_size: int,
@@ -339,12 +778,19 @@ class GenerateExamplesFn(beam.DoFn):
     self._before_path = before_path
     self._after_path = after_path
     self._labeling_image_sample_rate = labeling_image_sample_rate
+    self._labeling_images_dir = labeling_images_dir
     self._example_patch_size = example_patch_size
     self._alignment_patch_size = alignment_patch_size
     self._labeling_patch_size = labeling_patch_size
     self._resolution = resolution
     self._gdal_env = gdal_env
 
+    if (before_path.startswith('EEDAI:') or after_path.startswith('EEDAI:')):
+      qps_per_worker = _EARTH_ENGINE_QPS / _MAX_DATAFLOW_WORKERS
+      self._seconds_between_reads = 1.0 / qps_per_worker
+    else:
+      self._seconds_between_reads = 0
+
     self._example_count = Metrics.counter('skai', 'generated_examples_count')
     self._bad_example_count = Metrics.counter('skai', 'rejected_examples_count')
     self._before_patch_blank_count = Metrics.counter(
@@ -356,87 +802,265 @@ class GenerateExamplesFn(beam.DoFn):
     """Open before and after image rasters.
 
     This simply creates raster placeholders in memory. It doesn't actually read
-    the raster data from disk.
+    the raster data from disk. Per-raster constants and buffers that are reused
+    across elements are also created here.
     """
+    # Set these first so that teardown() can clean up if opening a raster fails.
+    # One thread per raster so that before and after image reads overlap.
+    # rasterio environments are thread-local, so each pool thread enters its
+    # own instead of relying on the one entered in start_bundle().
+    self._read_pool = concurrent.futures.ThreadPoolExecutor(
+        max_workers=2, initializer=_enter_gdal_env,
+        initargs=(self._gdal_env,))
+    self._before_raster = None
+    self._after_raster = None
     with rasterio.Env(**self._gdal_env):
-      self._before_raster = None
       if self._before_path:
         self._before_raster = rasterio.open(self._before_path)
+        self._before_transformer = _get_transformer(self._before_raster)
+        self._before_geometry = _get_patch_geometry(
+            _get_raster_resolution_in_meters(self._before_raster),
+            self._alignment_patch_size, self._resolution)
       self._after_raster = rasterio.open(self._after_path)
+      self._after_transformer = _get_transformer(self._after_raster)
+      after_res_m = _get_raster_resolution_in_meters(self._after_raster)
+
+    self._after_geometry = _get_patch_geometry(
+        after_res_m,
+        _get_after_patch_size(
+            bool(self._before_path), self._example_patch_size,
+            self._alignment_patch_size, self._labeling_patch_size),
+        self._resolution)
+    if self._before_raster is None:
+      # No before image, so the before patch is always all zeros.
+      patch_size = self._after_geometry.patch_size
+      self._blank_before_patch = np.zeros(
+          (patch_size, patch_size, 3), dtype=np.uint8)
+
+    # Buffers reused by every read and alignment.
+    self._before_read_buffer = _ReadBuffer()
+    self._after_read_buffer = _ReadBuffer()
+    after_patch_size = self._alignment_patch_size + 2 * _MAX_DISPLACEMENT
+    self._before_gray = np.empty(
+        (self._alignment_patch_size, self._alignment_patch_size),
+        dtype=np.uint8)
+    self._after_gray = np.empty(
+        (after_patch_size, after_patch_size), dtype=np.uint8)
+
+  def start_bundle(self) -> None:
+    # Enter the GDAL environment once per bundle rather than once per element.
+    # This isn't done in setup() because rasterio environments are thread-local
+    # and Beam may call setup() and process() from different threads.
+    self._env = rasterio.Env(**self._gdal_env)
+    self._env.__enter__()
+
+  def finish_bundle(self) -> None:
+    self._env.__exit__()
+
+  def teardown(self) -> None:
+    self._read_pool.shutdown()
+    if self._before_raster is not None:
+      self._before_raster.close()
+    if self._after_raster is not None:
+      self._after_raster.close()
 
   def process(
-      self, coordinate: _Coordinate) -> Iterator[beam.pvalue.TaggedOutput]:
+      self, block_coordinates: Tuple[Tuple[int, int], Iterable[_Coordinate]]
+  ) -> Iterator[bytes]:
     """Extract patches from before and after images and output as tf Example.
 
+    All coordinates in the input fall in the same grid cell of the after image,
+    so the patches for all of them can usually be fetched with a single read
+    per image. Coordinates are split across several reads if a single read
+    would be larger than _MAX_READ_SIZE.
+
     Args:
-      coordinate: Longitude and latitude of the center the of patch.
+      block_coordinates: Tuple of raster block index and the coordinates of the
+        patch centers that fall in that block.
 
     Yields:
       Serialized Tensorflow Example.
     """
-
-    if (self._before_path.startswith('EEDAI:') or
-        self._after_path.startswith('EEDAI:')):
-      qps_per_worker = _EARTH_ENGINE_QPS / _MAX_DATAFLOW_WORKERS
-      seconds_between_reads = 1.0 / qps_per_worker
+    _, coordinates = block_coordinates
+    coordinates = np.array(list(coordinates), dtype=np.float64)
+    longitudes = coordinates[:, 0]
+    latitudes = coordinates[:, 1]
+    labels = coordinates[:, 2]
+
+    if self._before_raster is None:
+      before_patches = [self._blank_before_patch] * len(coordinates)
+      after_xs, after_ys = _transform_batch(
+          self._after_transformer, longitudes, latitudes)
+      after_patches = _get_patches_at_points(
+          self._after_raster, self._after_geometry, after_xs, after_ys,
+          self._seconds_between_reads, read_buffer=self._after_read_buffer)
     else:
-      seconds_between_reads = 0
-
-    with rasterio.Env(**self._gdal_env):
-      if self._before_raster is None:
-        patch_size = max(self._example_patch_size, self._labeling_patch_size)
-        # No before image, so just set the before patch to all zeros.
-        before_patch = np.zeros((patch_size, patch_size, 3), dtype=np.uint8)
-        after_patch = get_patch_at_coordinate(
-            self._after_raster, coordinate.longitude, coordinate.latitude,
-            patch_size, self._resolution, seconds_between_reads)
-      else:
-        before_patch = get_patch_at_coordinate(
-            self._before_raster, coordinate.longitude, coordinate.latitude,
-            self._alignment_patch_size, self._resolution, seconds_between_reads)
-
-        if before_patch is None:
-          self._before_patch_blank_count.inc()
-          self._bad_example_count.inc()
-          return
-
-        # Make the after image patch larger than the before image patch by
-        # giving it a border of _MAX_DISPLACEMENT pixels. This gives the
-        # alignment algorithm at most +/-_MAX_DISPLACEMENT pixels of movement in
-        # either dimension to find the best alignment.
-        after_patch_size = self._alignment_patch_size + 2 * _MAX_DISPLACEMENT
-        after_patch = get_patch_at_coordinate(
-            self._after_raster, coordinate.longitude, coordinate.latitude,
-            after_patch_size, self._resolution, seconds_between_reads)
+      before_xs, before_ys = _transform_batch(
+          self._before_transformer, longitudes, latitudes)
+      after_xs, after_ys = _transform_batch(
+          self._after_transformer, longitudes, latitudes)
+      before_offsets = _get_patch_offsets(
+          self._before_raster, self._before_geometry, before_xs, before_ys)
+      after_offsets = _get_patch_offsets(
+          self._after_raster, self._after_geometry, after_xs, after_ys)
+      # Split the coordinates so that the reads from both rasters are bounded.
+      groups = _split_by_cells(np.hstack([
+          _get_read_cells(self._before_geometry, before_offsets),
+          _get_read_cells(self._after_geometry, after_offsets)]))
+
+      # Read from both rasters concurrently. Each read waits twice as long
+      # afterwards so that the two reads together stay within the QPS limit.
+      # Patch extraction stays on this thread because Beam metrics are
+      # thread-local.
+      wait_seconds = 2 * self._seconds_between_reads
+      before_patches = [None] * len(coordinates)
+      all_after_patches = [None] * len(coordinates)
+      for indices in groups:
+        before_read = _plan_patch_read(
+            self._before_raster, self._before_geometry,
+            before_offsets[indices])
+        after_read = _plan_patch_read(
+            self._after_raster, self._after_geometry, after_offsets[indices])
+        before_future = self._read_pool.submit(
+            _read_window, self._before_raster, before_read, wait_seconds,
+            _RESAMPLING, self._before_read_buffer)
+        after_future = self._read_pool.submit(
+            _read_window, self._after_raster, after_read, wait_seconds,
+            _RESAMPLING, self._after_read_buffer)
+        for i, before_patch, after_patch in zip(
+            indices, _extract_patches(before_future.result, before_read),
+            _extract_patches(after_future.result, after_read)):
+          before_patches[i] = before_patch
+          all_after_patches[i] = after_patch
+
+      # Only use after image patches for coordinates with a valid before
+      # image patch.
+      valid = [i for i, p in enumerate(before_patches) if p is not None]
+      self._before_patch_blank_count.inc(len(coordinates) - len(valid))
+      self._bad_example_count.inc(len(coordinates) - len(valid))
+      valid_after_patches = [all_after_patches[i] for i in valid]
+      after_patches = [None] * len(coordinates)
+      for i, after_patch in zip(valid, valid_after_patches):
         if after_patch is not None:
           # Try to align after image to before image.
-          after_patch = align_after_image(before_patch, after_patch)
-
-      if after_patch is None:
-        self._after_patch_blank_count.inc()
-        self._bad_example_count.inc()
-        return
-
-      example = _create_example(
-          _center_crop(before_patch, self._example_patch_size),
-          _center_crop(after_patch, self._example_patch_size),
-          coordinate.longitude, coordinate.latitude, coordinate.label)
-
-      self._example_count.inc()
-      yield beam.pvalue.TaggedOutput(_EXAMPLES, example.SerializeToString())
-
-      if random.random() < self._labeling_image_sample_rate:
-        labeling_image = cloud_labeling.create_labeling_image(
-            _center_crop(before_patch, self._labeling_patch_size),
-            _center_crop(after_patch, self._labeling_patch_size))
-        serialized_labeling_image = utils.serialize_image(
-            labeling_image, 'png')
-        encoded_coords = utils.encode_coordinates(
-            coordinate.longitude, coordinate.latitude).decode()
-        labeling_image_name = f'{encoded_coords}.png'
-        yield beam.pvalue.TaggedOutput(
-            _LABELING_IMAGES,
-            (labeling_image_name, serialized_labeling_image))
+          after_patch = align_after_image(
+              before_patches[i], after_patch, self._before_gray,
+              self._after_gray)
+        after_patches[i] = after_patch
+
+    for longitude, latitude, label, before_patch, after_patch in zip(
+        longitudes.tolist(), latitudes.tolist(), labels.tolist(),
+        before_patches, after_patches):
+      if before_patch is None:
+        continue
+      yield from self._generate_outputs(
+          longitude, latitude, label, before_patch, after_patch)
+
+  def _generate_outputs(
+      self, longitude: float, latitude: float, label: float,
+      before_patch: np.ndarray,
+      after_patch: Optional[np.ndarray]) -> Iterator[bytes]:
+    """Creates the example and labeling image for a single coordinate.
+
+    Args:
+      longitude: Longitude of the center of the patch.
+      latitude: Latitude of the center of the patch.
+      label: Label for this example.
+      before_patch: Before image patch.
+      after_patch: After image patch, aligned to the before image patch.
+
+    Yields:
+      Serialized Tensorflow Example.
+    """
+    if after_patch is None:
+      self._after_patch_blank_count.inc()
+      self._bad_example_count.inc()
+      return
+
+    before_crop = _center_crop(before_patch, self._example_patch_size)
+    after_crop = _center_crop(after_patch, self._example_patch_size)
+    example = _create_example(
+        before_crop, after_crop, longitude, latitude, label)
+
+    self._example_count.inc()
+    yield example.SerializeToString()
+
+    if random.random() < self._labeling_image_sample_rate:
+      # Reuse the example crops if they are already the right size.
+      if self._labeling_patch_size != self._example_patch_size:
+        before_crop = _center_crop(before_patch, self._labeling_patch_size)
+        after_crop = _center_crop(after_patch, self._labeling_patch_size)
+      labeling_image = cloud_labeling.create_labeling_image(
+          PIL.Image.fromarray(before_crop), PIL.Image.fromarray(after_crop))
+      serialized_labeling_image = utils.serialize_image(
+          labeling_image, 'png', _PNG_COMPRESS_LEVEL)
+      encoded_coords = utils.encode_coordinates(longitude, latitude).decode()
+      labeling_image_path = os.path.join(
+          self._labeling_images_dir, f'{encoded_coords}.png')
+      # Write the image directly rather than passing it through the pipeline.
+      # File names are derived from the coordinates, so retried bundles simply
+      # overwrite the same files.
+      with tf.io.gfile.GFile(labeling_image_path, 'wb') as f:
+        f.write(serialized_labeling_image)
+
+
+class AssignRasterBlockFn(beam.DoFn):
+  """DoFn that keys coordinates by the raster block they fall in.
+
+  Grouping coordinates by block lets GenerateExamplesFn fetch the patches for
+  nearby coordinates with a single raster read. Blocks are capped at the size
+  of a patch in raster pixels, since e.g. untiled GeoTIFFs have blocks that
+  span the full width of the raster.
+
+  Attributes:
+    _image_path: Path to the image whose block layout is used.
+    _patch_size: Size of patches read from the image.
+    _resolution: Desired resolution of patches read from the image.
+    _gdal_env: GDAL environment configuration.
+  """
+
+  def __init__(self,
+               image_path: str,
+               patch_size: int,
+               resolution: float,
+               gdal_env: Dict[str, str]) -> None:
+    self._image_path = image_path
+    self._patch_size = patch_size
+    self._resolution = resolution
+    self._gdal_env = gdal_env
+
+  def setup(self) -> None:
+    self._raster = None
+    with rasterio.Env(**self._gdal_env):
+      self._raster = rasterio.open(self._image_path)
+      self._transformer = _get_transformer(self._raster)
+      input_size = _get_patch_geometry(
+          _get_raster_resolution_in_meters(self._raster), self._patch_size,
+          self._resolution).input_size
+    block_height, block_width = self._raster.block_shapes[0]
+    self._block_height = max(1, min(block_height, input_size))
+    self._block_width = max(1, min(block_width, input_size))
+
+  def teardown(self) -> None:
+    if self._raster is not None:
+      self._raster.close()
+
+  def process(
+      self, coordinate: _Coordinate
+  ) -> Iterator[Tuple[Tuple[int, int], _Coordinate]]:
+    """Keys a coordinate by its raster block index.
+
+    Args:
+      coordinate: Longitude, latitude and label of the center the of patch.
+
+    Yields:
+      Tuple of (block row, block column) and the coordinate.
+    """
+    longitude, latitude, _ = coordinate
+    x, y = self._transformer.transform(longitude, latitude, errcheck=True)
+    row, col = rasterio.transform.rowcol(self._raster.transform, x, y)
+    yield (int(row) // self._block_height,
+           int(col) // self._block_width), coordinate
 
 
 def _get_setup_file_path():
@@ -492,9 +1116,10 @@ def _generate_examples(
     labeling_patch_size: int,
     resolution: float,
     labeling_image_sample_rate: float,
+    labeling_images_dir: str,
     gdal_env: Dict[str, str],
     coordinates: beam.PCollection,
-    stage_prefix: str) -> Tuple[beam.PCollection, beam.PCollection]:
+    stage_prefix: str) -> beam.PCollection:
   """Generates examples and labeling images from source images.
 
   Args:
@@ -508,30 +1133,57 @@ def _generate_examples(
       labeling.
     resolution: Desired resolution of image patches.
     labeling_image_sample_rate: Rate at which to sample labeling images.
+    labeling_images_dir: Directory to write labeling images to.
     gdal_env: GDAL environment configuration.
     coordinates: Collection of coordinates (longitude, latitude, label) to
       extract examples for.
     stage_prefix: Beam stage name prefix.
 
   Returns:
-    PCollection of examples and PCollection of labeling images.
+    PCollection of examples.
   """
 
-  results = (
+  return (
       coordinates
+      | stage_prefix + '_assign_raster_blocks' >> beam.ParDo(
+          AssignRasterBlockFn(
+              after_image_path,
+              _get_after_patch_size(
+                  bool(before_image_path), example_patch_size,
+                  alignment_patch_size, labeling_patch_size),
+              resolution, gdal_env))
+      | stage_prefix + '_group_by_raster_block' >> beam.GroupByKey()
       | stage_prefix + '_generate_examples' >> beam.ParDo(
           GenerateExamplesFn(
               before_image_path, after_image_path, labeling_image_sample_rate,
-              example_patch_size, alignment_patch_size, labeling_patch_size,
-              resolution, gdal_env)).with_outputs(_EXAMPLES, _LABELING_IMAGES))
-  examples = results[_EXAMPLES]
-  labeling_images = results[_LABELING_IMAGES]
-  return examples, labeling_images
+              labeling_images_dir, example_patch_size, alignment_patch_size,
+              labeling_patch_size, resolution, gdal_env)))
 
 
-def _parse_coords_from_csv_line(line: str) -> _Coordinate:
-  x, y = [float(w.strip()) for w in line.split(',')]
-  return _Coordinate(x, y, -1.0)
+def _write_coordinates_file(coordinates: np.ndarray, path: str) -> None:
+  """Writes a coordinate array to a binary .npy file.
+
+  Args:
+    coordinates: Array with shape (N, 3) holding longitude, latitude and label
+      columns.
+    path: Output path.
+  """
+  with tf.io.gfile.GFile(path, 'wb') as f:
+    np.save(f, coordinates.astype(np.float64, copy=False))
+
+
+def _read_coordinates_file(path: str) -> Iterator[_Coordinate]:
+  """Reads coordinates written by _write_coordinates_file.
+
+  Args:
+    path: Path to the .npy file.
+
+  Yields:
+    (longitude, latitude, label) tuples.
+  """
+  with tf.io.gfile.GFile(path, 'rb') as f:
+    coordinates = np.load(f)
+  yield from _to_coordinate_tuples(coordinates)
 
 
 def read_labels_file(
@@ -559,22 +1211,41 @@ def read_labels_file(
   """
 
   df = gpd.read_file(path).to_crs(epsg=4326)
-  coordinates = []
-  for _, row in df.iterrows():
-    centroid = row.geometry.centroid
-    label = row[label_property]
-    if isinstance(label, str):
-      try:
-        float_label = float(class_names.index(label))
-      except ValueError:
-        # Class is not recognized, so skip this coordinate.
-        continue
-    elif isinstance(label, (int, float)):
-      float_label = float(label)
-    else:
-      raise ValueError(f'Unrecognized label property type {type(label)}')
-
-    coordinates.append((centroid.x, centroid.y, float_label))
+  if df.empty:
+    return []
+
+  centroids = shapely.centroid(df.geometry.to_numpy())
+  longitudes = shapely.get_x(centroids)
+  latitudes = shapely.get_y(centroids)
+  labels = df[label_property]
+  if labels.dtype.kind in 'biuf':
+    float_labels = labels.to_numpy(dtype=np.float64)
+  else:
+    # String or object columns may mix class names with numeric labels, so
+    # check the type of each label.
+    is_name = labels.map(lambda l: isinstance(l, str)).to_numpy(dtype=bool)
+    is_number = labels.map(
+        lambda l: isinstance(l, (int, float, np.number))).to_numpy(dtype=bool)
+    if not np.all(is_name | is_number):
+      bad_label = labels[~(is_name | is_number)].iloc[0]
+      raise ValueError(f'Unrecognized label property type {type(bad_label)}')
+
+    # Map each class name to its first index in class_names.
+    class_to_idx = {}
+    for i, name in enumerate(class_names):
+      class_to_idx.setdefault(name, float(i))
+    float_labels = np.empty(len(labels), dtype=np.float64)
+    float_labels[is_number] = labels[is_number].astype(np.float64)
+    float_labels[is_name] = labels[is_name].map(class_to_idx).astype(
+        np.float64)
+    # Classes that are not recognized map to NaN, so skip those coordinates.
+    keep = ~(is_name & np.isnan(float_labels))
+    longitudes = longitudes[keep]
+    latitudes = latitudes[keep]
+    float_labels = float_labels[keep]
+
+  coordinates = list(
+      zip(longitudes.tolist(), latitudes.tolist(), float_labels.tolist()))
 
   if max_points:
     coordinates = coordinates[:max_points]
@@ -682,28 +1353,36 @@ def generate_examples_pipeline(
     if unlabeled_coordinates:
       labeling_image_sample_rate = (
           num_labeling_images / len(unlabeled_coordinates))
+      unlabeled_coordinates = _to_coordinate_array(unlabeled_coordinates, -1.0)
       if use_dataflow:
+        # Pass the coordinates through a file rather than beam.Create to keep
+        # them out of the Dataflow job graph.
         unlabeled_coordinates_path = os.path.join(temp_dir,
-                                                  'unlabeled_coordinates.csv')
-        with tf.io.gfile.GFile(unlabeled_coordinates_path, 'w') as f:
-          for x, y in unlabeled_coordinates:
-            f.write(f'{x:.12f},{y:.12f}\n')
+                                                  'unlabeled_coordinates.npy')
+        _write_coordinates_file(unlabeled_coordinates,
+                                unlabeled_coordinates_path)
         unlabeled_coordinates_pcollection = (
             pipeline
-            | beam.io.ReadFromText(unlabeled_coordinates_path)
-            | beam.Map(_parse_coords_from_csv_line))
+            | 'create_unlabeled_coordinates_path' >> beam.Create(
+                [unlabeled_coordinates_path])
+            # The file is read by a single worker. The GroupByKey on raster
+            # blocks in _generate_examples spreads the coordinates out.
+            | 'read_unlabeled_coordinates' >> beam.FlatMap(
+                _read_coordinates_file))
       else:
         unlabeled_coordinates_pcollection = (
             pipeline
-            | 'create_unlabeled_coordinates' >> beam.Create([
-                _Coordinate(lng, lat, -1.0)
-                for lng, lat in unlabeled_coordinates
-            ]))
+            | 'create_unlabeled_coordinates' >> beam.Create(
+                _to_coordinate_tuples(unlabeled_coordinates)))
 
-      unlabeled_examples, labeling_images = _generate_examples(
+      labeling_images_dir = (
+          os.path.join(output_dir, 'examples', 'labeling_images'))
+      if num_labeling_images > 0:
+        tf.io.gfile.makedirs(labeling_images_dir)
+      unlabeled_examples = _generate_examples(
           before_image_path, after_image_path, example_patch_size,
           alignment_patch_size, labeling_patch_size, resolution,
-          labeling_image_sample_rate, gdal_env,
+          labeling_image_sample_rate, labeling_images_dir, gdal_env,
           unlabeled_coordinates_pcollection, 'unlabeled')
 
       unlabeled_examples_output_prefix = (
@@ -716,23 +1395,15 @@ def generate_examples_pipeline(
               file_name_suffix='.tfrecord',
               num_shards=num_output_shards))
 
-      if num_labeling_images > 0:
-        labeling_images_dir = (
-            os.path.join(output_dir, 'examples', 'labeling_images'))
-        beam_utils.write_records_as_files(labeling_images, labeling_images_dir,
-                                          temp_dir, 'write_labeling_images')
-
     if labeled_coordinates:
       labeled_coordinates_pcollection = (
           pipeline
-          | 'create_labeled_coordinates' >> beam.Create([
-              _Coordinate(lng, lat, label)
-              for lng, lat, label in labeled_coordinates
-          ]))
+          | 'create_labeled_coordinates' >> beam.Create(
+              _to_coordinate_tuples(_to_coordinate_array(labeled_coordinates))))
 
-      labeled_examples, _ = _generate_examples(
+      labeled_examples = _generate_examples(
           before_image_path, after_image_path, example_patch_size,
-          alignment_patch_size, labeling_patch_size, resolution, 0,
+          alignment_patch_size, labeling_patch_size, resolution, 0, '',
           gdal_env, labeled_coordinates_pcollection, 'labeled')
 
       labeled_examples_output_prefix = (
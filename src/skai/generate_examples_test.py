@@ -14,16 +14,22 @@
 
 """Tests for generate_examples.py."""
 
+import concurrent.futures
+import json
 import os
 import pathlib
 import tempfile
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 from absl.testing import absltest
 
 import apache_beam as beam
 from apache_beam.testing import test_pipeline
 from apache_beam.testing.util import assert_that
+import geopandas as gpd
 import numpy as np
+import pyproj
+import rasterio
+import shapely.geometry
 from skai import generate_examples
 from skai import utils
 import tensorflow as tf
@@ -100,33 +106,87 @@ def _check_serialized_examples(expected_patch_size: int,
   return _check_examples
 
 
-def _check_labeling_images(expected_width: int,
+def _check_labeling_images(labeling_images_dir: str,
+                           expected_width: int,
                            expected_height: int,
                            expected_coordinates: List[Tuple[float, float]]):
-  """Validates labeling images generated by beam pipeline.
+  """Validates labeling images written by beam pipeline.
 
   Args:
+    labeling_images_dir: Directory the labeling images were written to.
     expected_width: The expected size of encoded patches.
     expected_height: The expected size of encoded patches.
     expected_coordinates: List of coordinates that examples should have.
+  """
+  actual_coordinates = set()
+  for name in os.listdir(labeling_images_dir):
+    assert name.endswith('.png'), name
+    encoded_coords = name[:-4]  # Remove ".png" suffix.
+    longitude, latitude = utils.decode_coordinates(encoded_coords)
+    actual_coordinates.add((longitude, latitude))
+    with open(os.path.join(labeling_images_dir, name), 'rb') as f:
+      image = _deserialize_image(f.read())
+    assert image.shape == (expected_height, expected_width, 3)
+
+  assert _unordered_all_close(expected_coordinates, actual_coordinates)
+
+
+def _write_raster(data: np.ndarray, crs: str, transform) -> str:
+  """Writes an image to a temporary GeoTIFF file.
+
+  Args:
+    data: Image with dimensions [bands, rows, cols].
+    crs: Coordinate reference system of the image.
+    transform: Affine transform of the image.
 
   Returns:
-    Function for validating examples.
+    Path to the GeoTIFF file.
   """
+  profile = {
+      'driver': 'GTiff', 'width': data.shape[2], 'height': data.shape[1],
+      'count': data.shape[0], 'dtype': data.dtype.name, 'crs': crs,
+      'transform': transform,
+  }
+  image_path = os.path.join(
+      tempfile.mkdtemp(dir=absltest.TEST_TMPDIR.value), 'image.tif')
+  with rasterio.open(image_path, 'w', **profile) as raster:
+    raster.write(data)
+  return image_path
 
-  def _check_images(actual_serialized_images):
-    actual_coordinates = set()
-    for name, serialized_image in actual_serialized_images:
-      assert name.endswith('.png'), name
-      encoded_coords = name[:-4]  # Remove ".png" suffix.
-      longitude, latitude = utils.decode_coordinates(encoded_coords)
-      actual_coordinates.add((longitude, latitude))
-      image = _deserialize_image(serialized_image)
-      assert image.shape == (expected_height, expected_width, 3)
 
-    assert _unordered_all_close(expected_coordinates, actual_coordinates)
+def _write_constant_raster(dtype: np.dtype, value: float) -> str:
+  """Writes a 64x64 pixel, 3 band raster filled with a single value.
+
+  The raster has a resolution of about 1.11m at its location, so patches read
+  from it at a resolution of 1.11m aren't resampled.
+
+  Args:
+    dtype: Data type of the raster.
+    value: Value of every pixel.
+
+  Returns:
+    Path to the GeoTIFF file.
+  """
+  return _write_raster(
+      np.full((3, 64, 64), value, dtype=dtype), 'EPSG:4326',
+      rasterio.transform.from_origin(178.0, -16.0, 1e-5, 1e-5))
+
+
+def _get_constant_raster_patch(raster) -> Optional[np.ndarray]:
+  """Reads a 32x32 patch from the center of a _write_constant_raster image."""
+  return generate_examples.get_patch_at_coordinate(
+      raster, 178.00032, -16.00032, 32, 1.11, 0)
+
 
-  return _check_images
+def _get_pixel_coordinates(
+    raster, pixels: List[Tuple[int, int]]) -> Tuple[List[float], List[float]]:
+  """Returns the longitudes and latitudes of the centers of raster pixels."""
+  xs, ys = rasterio.transform.xy(
+      raster.transform, [r for r, _ in pixels], [c for _, c in pixels])
+  transformer = pyproj.Transformer.from_crs(
+      raster.crs, 'epsg:4326', always_xy=True)
+  longitudes, latitudes = transformer.transform(xs, ys)
+  return list(longitudes), list(latitudes)
 
 
 class GenerateExamplesTest(absltest.TestCase):
@@ -139,60 +199,283 @@ class GenerateExamplesTest(absltest.TestCase):
   def testGenerateExamplesFn(self):
     """Tests GenerateExamplesFn class."""
 
-    coordinates = [
-        generate_examples._Coordinate(178.482925, -16.632893, -1),
-        generate_examples._Coordinate(178.482283, -16.632279, -1)]
+    coordinates = [(178.482925, -16.632893, -1.0),
+                   (178.482283, -16.632279, -1.0)]
 
+    labeling_images_dir = tempfile.mkdtemp(dir=absltest.TEST_TMPDIR.value)
     with test_pipeline.TestPipeline() as pipeline:
       coordinates_pcollection = (
           pipeline
           | beam.Create(coordinates))
 
-      examples, labeling_images = generate_examples._generate_examples(
-          self.test_image_path, self.test_image_path, 32, 64, 62, 0.5, 1, {},
-          coordinates_pcollection, 'unlabeled')
+      examples = generate_examples._generate_examples(
+          self.test_image_path, self.test_image_path, 32, 64, 62, 0.5, 1,
+          labeling_images_dir, {}, coordinates_pcollection, 'unlabeled')
 
       # Example at second input coordinate should be dropped because its patch
       # falls mostly outside the before and after image bounds.
       assert_that(examples, _check_serialized_examples(
           32, [(178.482925, -16.632893)], False), label='assert_examples')
 
-      expected_width = 154   # 62 + 62 + 10 * 3
-      expected_height = 114  # 62 + 2 * 10 + height for caption
-      assert_that(
-          labeling_images,
-          _check_labeling_images(expected_width, expected_height,
-                                 [(178.482925, -16.632893)]),
-          label='assert_labeling_images')
+    expected_width = 154   # 62 + 62 + 10 * 3
+    expected_height = 114  # 62 + 2 * 10 + height for caption
+    _check_labeling_images(labeling_images_dir, expected_width,
+                           expected_height, [(178.482925, -16.632893)])
 
   def testGenerateExamplesFnNoBefore(self):
     """Tests GenerateExamplesFn class without before image."""
 
-    coordinates = [
-        generate_examples._Coordinate(178.482925, -16.632893, -1),
-        generate_examples._Coordinate(178.482283, -16.632279, -1)]
+    coordinates = [(178.482925, -16.632893, -1.0),
+                   (178.482283, -16.632279, -1.0)]
 
+    labeling_images_dir = tempfile.mkdtemp(dir=absltest.TEST_TMPDIR.value)
     with test_pipeline.TestPipeline() as pipeline:
       coordinates_pcollection = (
           pipeline
           | beam.Create(coordinates))
 
-      examples, labeling_images = generate_examples._generate_examples(
-          '', self.test_image_path, 32, 64, 62, 0.5, 1, {},
-          coordinates_pcollection, 'unlabeled')
+      examples = generate_examples._generate_examples(
+          '', self.test_image_path, 32, 64, 62, 0.5, 1,
+          labeling_images_dir, {}, coordinates_pcollection, 'unlabeled')
 
       # Example at second input coordinate should be dropped because its patch
       # falls mostly outside the before and after image bounds.
       assert_that(examples, _check_serialized_examples(
           32, [(178.482925, -16.632893)], True), label='assert_examples')
 
-      expected_width = 154   # 62 + 62 + 10 * 3
-      expected_height = 114  # 62 + 2 * 10 + height for caption
-      assert_that(
-          labeling_images,
-          _check_labeling_images(expected_width, expected_height,
-                                 [(178.482925, -16.632893)]),
-          label='assert_labeling_images')
+    expected_width = 154   # 62 + 62 + 10 * 3
+    expected_height = 114  # 62 + 2 * 10 + height for caption
+    _check_labeling_images(labeling_images_dir, expected_width,
+                           expected_height, [(178.482925, -16.632893)])
+
+  def testGenerateExamplesFnTeardownAfterFailedSetup(self):
+    """Tests that teardown doesn't hide errors from a failed setup."""
+    generate_examples_fn = generate_examples.GenerateExamplesFn(
+        self.test_image_path, '/nonexistent/after.tif', 0, '', 32, 40, 32, 0.5,
+        {})
+    with self.assertRaises(rasterio.errors.RasterioIOError):
+      generate_examples_fn.setup()
+    generate_examples_fn.teardown()
+
+  def testGenerateExamplesFnReadsUseGdalEnvOffMainThread(self):
+    """Tests that raster reads see the GDAL options when run by a worker."""
+    options_seen = []
+    read_window = generate_examples._read_window
+
+    def recording_read_window(*args):
+      options_seen.append(rasterio.env.get_gdal_config('SKAI_TEST_OPTION'))
+      return read_window(*args)
+
+    generate_examples._read_window = recording_read_window
+    self.addCleanup(setattr, generate_examples, '_read_window', read_window)
+    generate_examples_fn = generate_examples.GenerateExamplesFn(
+        self.test_image_path, self.test_image_path, 0, '', 32, 40, 32, 0.5,
+        {'SKAI_TEST_OPTION': 'skai'})
+
+    def run_bundle():
+      generate_examples_fn.setup()
+      generate_examples_fn.start_bundle()
+      list(generate_examples_fn.process(
+          ((0, 0), [(178.482925, -16.632893, 0.0)])))
+      generate_examples_fn.finish_bundle()
+      generate_examples_fn.teardown()
+
+    # Beam runs bundles on threads other than the main thread.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+      executor.submit(run_bundle).result()
+    self.assertEqual(options_seen, ['skai', 'skai'])
+
+  def testGetPatchesAtCoordinatesMatchesPerPointReads(self):
+    """Tests that batched patch reads match independent per-point reads."""
+    rows, cols = np.mgrid[0:400, 0:400]
+    data = np.stack([
+        128 + 60 * np.sin(rows / 20) + 60 * np.cos(cols / 25),
+        128 + 100 * np.sin((rows + cols) / 40),
+        128 + 100 * np.cos((rows - cols) / 45)]).astype(np.uint8)
+    image_path = _write_raster(
+        data, 'EPSG:3857',
+        rasterio.transform.from_origin(1000.0, 2000.0, 0.5, 0.5))
+    patch_size = 32
+    with rasterio.open(image_path) as raster:
+      # The raster has 0.5m resolution, so these resolutions resample patches
+      # by factors of 1.375 and 2.
+      for resolution in (0.7, 1.0):
+        input_size = int(patch_size * resolution / 0.5)
+        # Pixel offsets of the patch centers from the top left one. Offsets
+        # that are multiples of input_size are whole numbers of output pixels.
+        aligned_offsets = [
+            (0, 0), (input_size, 0), (0, 2 * input_size),
+            (3 * input_size, input_size)]
+        unaligned_offsets = [(13, 7), (51, 90), (200, 31)]
+        offsets = aligned_offsets + unaligned_offsets
+        pixels = [(100 + r, 100 + c) for r, c in offsets]
+        longitudes, latitudes = _get_pixel_coordinates(raster, pixels)
+        patches = generate_examples.get_patches_at_coordinates(
+            raster, longitudes, latitudes, patch_size, resolution, 0)
+        self.assertLen(patches, len(pixels))
+        for i, (row, col) in enumerate(pixels):
+          window = rasterio.windows.Window(
+              col - input_size // 2, row - input_size // 2, input_size,
+              input_size)
+          expected_patch = raster.read(
+              indexes=[1, 2, 3], window=window, boundless=True, fill_value=-1,
+              out_shape=(3, patch_size, patch_size),
+              resampling=rasterio.enums.Resampling.lanczos).transpose(1, 2, 0)
+          if i < len(aligned_offsets):
+            np.testing.assert_array_equal(patches[i], expected_patch)
+          else:
+            # Other patches are moved by at most half an output pixel, i.e. at
+            # most one raster pixel. The image changes by at most 5.4 per
+            # raster pixel, plus some ringing from the Lanczos kernel.
+            np.testing.assert_allclose(
+                patches[i], expected_patch, rtol=0, atol=8)
+
+  def testReadsAreBounded(self):
+    """Tests that patches far apart are fetched with separate reads."""
+    geometry = generate_examples._get_patch_geometry(0.5, 32, 0.5)
+    offsets = np.array([[0, 0], [0, 5000], [10, 20]])
+    groups = generate_examples._split_by_cells(
+        generate_examples._get_read_cells(geometry, offsets))
+    self.assertCountEqual([g.tolist() for g in groups], [[0, 2], [1]])
+    with rasterio.open(self.test_image_path) as raster:
+      for indices in groups:
+        patch_read = generate_examples._plan_patch_read(
+            raster, geometry, offsets[indices])
+        self.assertLessEqual(
+            max(patch_read.out_shape), generate_examples._MAX_READ_SIZE)
+
+  def testAssignRasterBlockFnCapsStripBlocks(self):
+    """Tests that coordinates in the same wide strip can get different keys."""
+    image_path = _write_raster(
+        np.ones((3, 4, 5000), dtype=np.uint8), 'EPSG:3857',
+        rasterio.transform.from_origin(1000.0, 2000.0, 0.5, 0.5))
+    with rasterio.open(image_path) as raster:
+      self.assertEqual(raster.block_shapes[0][1], 5000)
+      longitudes, latitudes = _get_pixel_coordinates(
+          raster, [(1, 10), (1, 20), (1, 4000)])
+    assign_fn = generate_examples.AssignRasterBlockFn(image_path, 32, 0.5, {})
+    assign_fn.setup()
+    keys = [
+        next(assign_fn.process((longitude, latitude, 0.0)))[0]
+        for longitude, latitude in zip(longitudes, latitudes)]
+    assign_fn.teardown()
+    self.assertEqual(keys[0], keys[1])
+    self.assertNotEqual(keys[0], keys[2])
+
+  def testProcessPatch(self):
+    data = np.zeros((3, 4, 5), dtype=np.int32)
+    data[:, :2, :] = np.arange(30).reshape((3, 2, 5))
+    data[1, 3, 4] = -1
+    blank_fraction, image, max_value = generate_examples._process_patch(data)
+    # The bottom two rows except pixel (3, 4) are blank.
+    self.assertAlmostEqual(blank_fraction, 9 / 20)
+    self.assertEqual(image.dtype, np.uint8)
+    self.assertEqual(max_value, 29)
+    np.testing.assert_array_equal(
+        image, np.clip(data, 0, None).transpose((1, 2, 0)))
+
+  def testProcessPatchBlankFractionMatchesAnyReduction(self):
+    rng = np.random.default_rng(0)
+    for dtype in (np.uint8, np.int16, np.int32):
+      data = rng.integers(-1, 3, size=(3, 32, 32)).astype(dtype)
+      blank_fraction, _, _ = generate_examples._process_patch(data)
+      self.assertAlmostEqual(blank_fraction, 1.0 - np.any(data, axis=0).mean())
+
+  def testGetPatchesAtCoordinatesRejectsOutOfRangeValues(self):
+    image_path = _write_constant_raster(np.uint16, 1000)
+    with rasterio.open(image_path) as raster:
+      with self.assertRaisesRegex(ValueError, 'maximum of 1000'):
+        _get_constant_raster_patch(raster)
+
+  def testGetPatchesAtCoordinatesRejectsFloatRasters(self):
+    image_path = _write_constant_raster(np.float32, 1)
+    with rasterio.open(image_path) as raster:
+      with self.assertRaisesRegex(TypeError, 'float32 not supported'):
+        _get_constant_raster_patch(raster)
+
+  def testReadBufferIsReusedAndAligned(self):
+    read_buffer = generate_examples._ReadBuffer()
+    large = read_buffer.get((3, 10, 10), np.int32)
+    small = read_buffer.get((3, 4, 5), np.uint8)
+    self.assertEqual(large.shape, (3, 10, 10))
+    self.assertEqual(small.dtype, np.uint8)
+    self.assertTrue(np.shares_memory(large, small))
+    self.assertEqual(large.ctypes.data % 64, 0)
+
+  def testToCoordinateArray(self):
+    array = generate_examples._to_coordinate_array(
+        [(178.482925, -16.632893), (-178.482283, 16.632279)], -1.0)
+    np.testing.assert_array_equal(
+        array, [(178.482925, -16.632893, -1.0), (-178.482283, 16.632279, -1.0)])
+    with self.assertRaisesRegex(ValueError, 'Invalid longitude'):
+      generate_examples._to_coordinate_array(
+          [(0.0, 0.0, 1.0), (181.0, 0.0, 1.0)])
+    with self.assertRaisesRegex(ValueError, 'Invalid latitude'):
+      generate_examples._to_coordinate_array([(0.0, float('nan'), 1.0)])
+
+  def testCoordinatesFileRoundTrip(self):
+    path = os.path.join(
+        tempfile.mkdtemp(dir=absltest.TEST_TMPDIR.value), 'coordinates.npy')
+    coordinates = np.array(
+        [(178.482925, -16.632893, -1.0), (178.482283, -16.632279, 2.0)])
+    generate_examples._write_coordinates_file(coordinates, path)
+    self.assertEqual(
+        list(generate_examples._read_coordinates_file(path)),
+        [(178.482925, -16.632893, -1.0), (178.482283, -16.632279, 2.0)])
+
+  def testAlignAfterImage(self):
+    rng = np.random.default_rng(0)
+    after_image = rng.integers(0, 256, size=(100, 100, 3), dtype=np.uint8)
+    before_image = after_image[25:65, 32:72, :]
+    before_gray = np.empty((40, 40), dtype=np.uint8)
+    after_gray = np.empty((100, 100), dtype=np.uint8)
+    aligned = generate_examples.align_after_image(
+        before_image, after_image, before_gray, after_gray)
+    np.testing.assert_array_equal(aligned, before_image)
+
+  def testReadLabelsFile(self):
+    labels_path = os.path.join(
+        tempfile.mkdtemp(dir=absltest.TEST_TMPDIR.value), 'labels.geojson')
+    gpd.GeoDataFrame(
+        {'damage': ['destroyed', 'unknown', 'undamaged', 'damaged']},
+        geometry=[
+            shapely.geometry.Point(178.1, -16.1),
+            shapely.geometry.Point(178.2, -16.2),
+            shapely.geometry.box(178.3, -16.4, 178.4, -16.3),
+            shapely.geometry.Point(178.5, -16.5),
+        ],
+        crs='EPSG:4326').to_file(labels_path, driver='GeoJSON')
+    coordinates = generate_examples.read_labels_file(
+        labels_path, 'damage', ['undamaged', 'damaged', 'destroyed'], 0)
+    np.testing.assert_allclose(
+        coordinates,
+        [(178.1, -16.1, 2.0), (178.35, -16.35, 0.0), (178.5, -16.5, 1.0)])
+    # Duplicate class names map to the index of their first occurrence.
+    coordinates = generate_examples.read_labels_file(
+        labels_path, 'damage', ['undamaged', 'damaged', 'damaged'], 0)
+    np.testing.assert_allclose(
+        coordinates, [(178.35, -16.35, 0.0), (178.5, -16.5, 1.0)])
+
+  def testReadLabelsFileMixedLabelTypes(self):
+    labels_path = os.path.join(
+        tempfile.mkdtemp(dir=absltest.TEST_TMPDIR.value), 'labels.geojson')
+    features = [
+        {
+            'type': 'Feature',
+            'properties': {'damage': label},
+            'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+        } for label, lon, lat in [
+            ('destroyed', 178.1, -16.1), (1, 178.2, -16.2),
+            (None, 178.3, -16.3)]
+    ]
+    with open(labels_path, 'w') as f:
+      json.dump({'type': 'FeatureCollection', 'features': features}, f)
+    coordinates = generate_examples.read_labels_file(
+        labels_path, 'damage', ['undamaged', 'damaged', 'destroyed'], 0)
+    # The numeric label is read as the string "1", which is not a class name.
+    # Missing labels are read as NaN and kept, as numeric labels are.
+    np.testing.assert_allclose(
+        coordinates, [(178.1, -16.1, 2.0), (178.3, -16.3, np.nan)])
 
   def testGenerateExamplesPipeline(self):
     output_dir = tempfile.mkdtemp(dir=absltest.TEST_TMPDIR.value)
@@ -17,7 +17,7 @@
 import base64
 import io
 import struct
-from typing import Iterable, List, Tuple
+from typing import Iterable, List, Optional, Tuple, Union
 
 from absl import flags
 import numpy as np
@@ -28,18 +28,29 @@ Example = tf.train.Example
 Image = PIL.Image.Image
 
 
-def serialize_image(image: Image, image_format: str) -> bytes:
+def serialize_image(image: Union[Image, np.ndarray],
+                    image_format: str,
+                    compress_level: Optional[int] = None) -> bytes:
   """Serialize image using the specified format.
 
   Args:
-    image: Input image.
+    image: Input image, either as a PIL image or as a [rows, cols, channels]
+      array.
     image_format: Image format to use, e.g. "jpeg"
+    compress_level: Optional zlib compression level (0-9) for PNG images. Lower
+      levels encode faster but produce larger files. If None, PIL's default is
+      used.
 
   Returns:
     Serialized bytes.
   """
+  if isinstance(image, np.ndarray):
+    image = PIL.Image.fromarray(image)
+  save_args = {}
+  if compress_level is not None:
+    save_args['compress_level'] = compress_level
   buffer = io.BytesIO()
-  image.save(buffer, format=image_format)
+  image.save(buffer, format=image_format, **save_args)
   return buffer.getvalue()
 
 
@@ -20,7 +20,11 @@ def index():
     return render_template('index.html')
  
 # main driver function
+# This only starts Flask's development server for local testing. The container
+# serves the app with gunicorn instead (see WebAppDockerfile).
 if __name__ == "__main__":
  
     # run() method of Flask class runs the application
-    app.run(debug=True, host="0.0.0.0", threaded=True, port=int(os.environ.get("PORT", 8080)))
\ No newline at end of file
+    # Debug mode is opt-in since it enables the reloader and disables caching.
+    app.run(debug=os.environ.get("FLASK_DEBUG") == "1", host="0.0.0.0",
+            threaded=True, port=int(os.environ.get("PORT", 8080)))
\ No newline at end of file